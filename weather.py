@@ -1,12 +1,30 @@
+import asyncio
+import calendar
+import contextvars
+import functools
+import ipaddress
 import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+import diskcache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
-from langchain.agents import initialize_agent, Tool, AgentType
+from langchain.agents import AgentExecutor, Tool, create_tool_calling_agent
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 from langchain_groq import ChatGroq
 from dotenv import load_dotenv
 import json
+import orjson
 import re
+from string import Template
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,28 +33,224 @@ load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHERMAP_API_KEY")
 
-# Initialize LLM model (ChatGroq)
-llm = ChatGroq(
-    model="llama3-70b-8192",
-    temperature=0.5,
+# (connect, read) timeout for every outbound HTTP call so a slow API can't hang the app
+TIMEOUT = (3.05, 8)
+
+# Shared HTTP session so keep-alive reuses sockets across OpenWeatherMap/ipinfo/ip-api calls,
+# retrying transient failures with exponential backoff. One read retry lets an idempotent GET
+# recover from a stale keep-alive socket (RemoteDisconnected counts as a read error), and
+# Retry-After is ignored so a single call stays bounded by about 2x TIMEOUT plus short backoffs.
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        read=1,
+        backoff_factor=0.4,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
+
+# Geolocation providers raced against each other; both resolve the caller's IP server-side.
+# ip-api.com only serves plain http:// on its free tier, hence the http:// mount above.
+IP_LOCATION_PROVIDERS = (
+    "https://ipinfo.io/json",
+    "http://ip-api.com/json",
 )
 
+# Worker pool for the provider race, shared across Streamlit reruns (module globals are rebuilt on each rerun)
+@st.cache_resource
+def _executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+# OpenWeatherMap /forecast returns slots on a regular 3-hour grid
+FORECAST_STEP = 3 * 3600
+SLOTS_PER_DAY = 24 * 3600 // FORECAST_STEP
+FORECAST_MAX_SLOTS = 40
+
+# On-disk cache shared across Streamlit reruns and restarts; opened once per process since
+# module globals are rebuilt on every rerun
+@st.cache_resource
+def _disk_cache():
+    return diskcache.Cache(os.path.join(tempfile.gettempdir(), "wx"))
+
+# Decorator caching results in memory (LRU) backed by the disk cache, expiring after ttl seconds
+def cached(ttl, key=None, maxsize=128):
+    def decorator(func):
+        memory = OrderedDict()
+        # Tools may run concurrently on worker threads, so guard the in-memory tier
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key = (func.__name__,) + (key(*args, **kwargs) if key else args)
+            now = time.time()
+            with lock:
+                hit = memory.get(cache_key)
+                if hit is not None and hit[1] > now:
+                    memory.move_to_end(cache_key)
+                    return hit[0]
+            value, expires = _disk_cache().get(cache_key, expire_time=True)
+            if value is None:
+                value = func(*args, **kwargs)
+                # Don't cache failures so the next call retries the API
+                if value is None or (isinstance(value, dict) and "error" in value):
+                    return value
+                expires = now + ttl
+                _disk_cache().set(cache_key, value, expire=ttl)
+            with lock:
+                memory[cache_key] = (value, expires)
+                memory.move_to_end(cache_key)
+                if len(memory) > maxsize:
+                    memory.popitem(last=False)
+            return value
+
+        return wrapper
+    return decorator
+
+# Cache key for weather lookups: forecasts only differ per location and calendar day
+def _weather_cache_key(location, date=None):
+    return (location.strip().lower(), date.date().isoformat() if date else "now")
+
+# Function to look up the city from a single geolocation provider
+def _lookup_city(url):
+    response = SESSION.get(url, timeout=TIMEOUT)
+    if response.status_code == 200:
+        return orjson.loads(response.content).get("city")
+    return None
+
+# Client IP of the current Streamlit session; contextvars carry it into the agent's tool threads.
+# The ContextVar must be a single object shared across reruns: the agent is built once with
+# st.cache_resource, so its tools keep reading the globals of the first script run, while
+# invoke_agent sets the variable from the current run. A module-level ContextVar would be a
+# different object on every rerun, so it comes from st.cache_resource as well.
+@st.cache_resource
+def _client_ip_var():
+    return contextvars.ContextVar("client_ip", default=None)
+
+# IP locations keyed by client IP (None for the server's own IP), refreshed daily
+IP_LOCATION_TTL = 86400
+IP_CACHE_MAXSIZE = 1024
+
+# Module globals are rebuilt on every Streamlit rerun, so the IP cache lives in st.cache_resource.
+# It's an LRU guarded by a lock since tools run on worker threads.
+@st.cache_resource
+def _ip_cache():
+    return OrderedDict(), threading.Lock()
+
+# Function to read the client's IP for the incoming Streamlit request.
+# Assumes at most one trusted reverse proxy in front of the app: it appends the peer it saw as
+# the rightmost X-Forwarded-For entry, while entries to its left are client-supplied and can be
+# spoofed. Without a proxy there is no header and the socket peer address is used instead.
+def get_client_ip():
+    forwarded = st.context.headers.get("x-forwarded-for", "")
+    return forwarded.split(",")[-1].strip() or st.context.ip_address
+
+# Function to resolve the server's own location by racing the providers
+def _race_ip_providers():
+    # Take the first city that comes back. Losing requests that are already running can't be
+    # cancelled: they finish in the background and hold a pool worker until their timeout.
+    pending = {_executor().submit(_lookup_city, url) for url in IP_LOCATION_PROVIDERS}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    location = future.result()
+                except Exception:
+                    continue
+                if location:
+                    return location
+        return None
+    finally:
+        # Only drops requests still queued behind a busy worker
+        for future in pending:
+            future.cancel()
+
+# Function to return the client IP if it's a public address ipinfo can geolocate
+def _public_ip(ip):
+    if not ip:
+        return None
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    # Private, loopback and bogon addresses have no city, so fall back to the server's location
+    return str(address) if address.is_global else None
+
 # Function to fetch the location by IP
-@st.cache_data(ttl=600)
 def get_location_by_ip():
-    try:
-        ip_address = requests.get('https://api.ipify.org').text
-        url = f"https://ipinfo.io/{ip_address}/json"
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            location = data.get("city")
-            return location
-    except Exception:
+    ip = _public_ip(_client_ip_var().get())
+    entries, lock = _ip_cache()
+    with lock:
+        hit = entries.get(ip)
+        if hit is not None and hit[1] > time.time():
+            entries.move_to_end(ip)
+            return hit[0]
+    if ip:
+        # The client's IP is already known from the request headers, so a single lookup resolves it
+        try:
+            location = _lookup_city(f"https://ipinfo.io/{ip}/json")
+        except Exception:
+            location = None
+    else:
+        location = _race_ip_providers()
+    if location:
+        with lock:
+            entries[ip] = (location, time.time() + IP_LOCATION_TTL)
+            entries.move_to_end(ip)
+            if len(entries) > IP_CACHE_MAXSIZE:
+                entries.popitem(last=False)
+    return location
+
+# Function to get the UTC (year, month, day) of a unix timestamp without building a datetime
+def _utc_ymd(ts):
+    tm = time.gmtime(ts)
+    return tm.tm_year, tm.tm_mon, tm.tm_mday
+
+# Function to pick the first forecast slot that falls on the given date
+def _find_forecast_slot(forecasts, date):
+    if not forecasts:
+        return None
+    day = (date.year, date.month, date.day)
+    base = forecasts[0]["dt"]
+    if forecasts[-1]["dt"] - base == FORECAST_STEP * (len(forecasts) - 1):
+        # Uniform grid: the first slot at or after midnight UTC is directly computable
+        day_start = calendar.timegm(day + (0, 0, 0))
+        idx = max(0, -((base - day_start) // FORECAST_STEP))
+        if idx < len(forecasts) and _utc_ymd(forecasts[idx]["dt"]) == day:
+            return forecasts[idx]
         return None
+    # Irregular grid: fall back to a linear scan
+    for forecast in forecasts:
+        if _utc_ymd(forecast["dt"]) == day:
+            return forecast
+    return None
+
+# Function to build the weather dict from a /weather payload or a /forecast slot (same shape)
+def _parse_weather(location_name, entry):
+    # Bind the nested dicts once instead of re-probing them per field
+    main = entry["main"]
+    w0 = entry["weather"][0]
+    return {
+        "location": location_name,
+        "temperature": main["temp"],
+        "description": w0["description"],
+        "icon": w0["icon"],
+        "humidity": main["humidity"],
+        "pressure": main["pressure"],
+        "wind_speed": entry["wind"]["speed"],
+        "date": "%04d-%02d-%02d" % _utc_ymd(entry["dt"]),
+    }
 
 # Function to fetch weather data by city name
-@st.cache_data(ttl=600)
+@cached(ttl=900, key=_weather_cache_key)
 def get_weather(location, date=None):
     if date is None:
         # Use /weather endpoint for real-time current weather
@@ -50,113 +264,106 @@ def get_weather(location, date=None):
         "appid": OPENWEATHER_API_KEY,
         "units": "metric"
     }
+    if date is not None:
+        # Only request the 3-hour slots up to the end of the target day (8 per day, 40 max)
+        days_ahead = (date.date() - datetime.utcnow().date()).days
+        params["cnt"] = min(FORECAST_MAX_SLOTS, max(SLOTS_PER_DAY, (days_ahead + 1) * SLOTS_PER_DAY))
 
-    response = requests.get(url, params=params)
+    try:
+        response = SESSION.get(url, params=params, timeout=TIMEOUT)
+    except requests.RequestException:
+        return {"error": "Weather service is not responding. Please try again later."}
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
         if date:
             # Find the weather for the given date in the forecast data
-            for forecast in data["list"]:
-                forecast_time = datetime.utcfromtimestamp(forecast["dt"])
-                if forecast_time.date() == date.date():
-                    weather = {
-                        "location": data["city"]["name"],
-                        "temperature": forecast["main"]["temp"],
-                        "description": forecast["weather"][0]["description"],
-                        "icon": forecast["weather"][0]["icon"],
-                        "humidity": forecast["main"]["humidity"],
-                        "pressure": forecast["main"]["pressure"],
-                        "wind_speed": forecast["wind"]["speed"],
-                        "date": forecast_time.strftime('%Y-%m-%d'),
-                    }
-                    return weather
-            return {"error": "Weather data not available for this date."}
+            forecast = _find_forecast_slot(data["list"], date)
+            if forecast is None:
+                return {"error": "Weather data not available for this date."}
+            return _parse_weather(data["city"]["name"], forecast)
         else:
             # Return weather for the current day from /weather endpoint
-            weather = {
-                "location": data["name"],
-                "temperature": data["main"]["temp"],
-                "description": data["weather"][0]["description"],
-                "icon": data["weather"][0]["icon"],
-                "humidity": data["main"]["humidity"],
-                "pressure": data["main"]["pressure"],
-                "wind_speed": data["wind"]["speed"],
-                "date": datetime.utcfromtimestamp(data["dt"]).strftime('%Y-%m-%d'),
-            }
-            return weather
+            return _parse_weather(data["name"], data)
     else:
         return {"error": f"API error: {response.status_code}"}
 
-# Function to format weather data into a string
+# Narrative templates keyed by the keyword they match in the weather description
+WEATHER_TEMPLATES = {
+    "haze": Template(
+        "The weather in $location on $date will be characterized by $description with a temperature of ${temperature}°C. "
+        "The humidity is at $humidity%, making the air feel quite heavy and sticky, typical for this region. "
+        "Atmospheric pressure is $pressure hPa, suggesting stable conditions, though the haze indicates potential air quality concerns, possibly due to pollution or dust. "
+        "A gentle breeze at $wind_speed m/s offers slight relief but isn't strong enough to clear the haze. "
+        "Light clothing and staying hydrated are recommended, and consider limiting outdoor activities if you're sensitive to air quality."
+    ),
+    "cloud": Template(
+        "The weather in $location on $date will feature $description with a temperature of ${temperature}°C. "
+        "The cloud cover will provide some shade, offering relief from direct sunlight and making it feel more comfortable compared to clearer days. "
+        "With humidity at $humidity%, the air might feel a bit damp, and the pressure at $pressure hPa suggests a stable atmosphere. "
+        "Wind speed is $wind_speed m/s, which is mild and won’t significantly impact the day. "
+        "The cloudy conditions might hint at a chance of light rain or drizzle, so carrying an umbrella could be wise."
+    ),
+}
+DEFAULT_WEATHER_TEMPLATE = Template(
+    "The weather in $location on $date will be $description with a temperature of ${temperature}°C. "
+    "Humidity is at $humidity%, pressure at $pressure hPa, and wind speed at $wind_speed m/s. "
+    "Expect typical conditions for this weather pattern—stay prepared for changes and dress accordingly."
+)
+
 # Function to format weather data into a detailed string
 def format_weather_response(weather, days_ahead=None):
     if not weather or "error" in weather:
         return weather.get("error", "Could not fetch weather data.")
-    
-    # Basic weather details for the concise format
-    weather_details = (
-        f"Temperature: {weather['temperature']}°C, "
-        f"Weather: {weather['description']}, "
-        f"Humidity: {weather['humidity']}%, "
-        f"Pressure: {weather['pressure']} hPa, "
-        f"Wind Speed: {weather['wind_speed']} m/s"
-    )
-    
-    # Detailed narrative description
-    description = ""
-    if "haze" in weather['description'].lower():
-        description = (
-            f"The weather in {weather['location']} on {weather['date']} will be characterized by {weather['description']} with a temperature of {weather['temperature']}°C. "
-            f"The humidity is at {weather['humidity']}%, making the air feel quite heavy and sticky, typical for this region. "
-            f"Atmospheric pressure is {weather['pressure']} hPa, suggesting stable conditions, though the haze indicates potential air quality concerns, possibly due to pollution or dust. "
-            f"A gentle breeze at {weather['wind_speed']} m/s offers slight relief but isn't strong enough to clear the haze. "
-            f"Light clothing and staying hydrated are recommended, and consider limiting outdoor activities if you're sensitive to air quality."
-        )
-    elif "cloud" in weather['description'].lower():
-        description = (
-            f"The weather in {weather['location']} on {weather['date']} will feature {weather['description']} with a temperature of {weather['temperature']}°C. "
-            f"The cloud cover will provide some shade, offering relief from direct sunlight and making it feel more comfortable compared to clearer days. "
-            f"With humidity at {weather['humidity']}%, the air might feel a bit damp, and the pressure at {weather['pressure']} hPa suggests a stable atmosphere. "
-            f"Wind speed is {weather['wind_speed']} m/s, which is mild and won’t significantly impact the day. "
-            f"The cloudy conditions might hint at a chance of light rain or drizzle, so carrying an umbrella could be wise."
-        )
-    else:
-        description = (
-            f"The weather in {weather['location']} on {weather['date']} will be {weather['description']} with a temperature of {weather['temperature']}°C. "
-            f"Humidity is at {weather['humidity']}%, pressure at {weather['pressure']} hPa, and wind speed at {weather['wind_speed']} m/s. "
-            f"Expect typical conditions for this weather pattern—stay prepared for changes and dress accordingly."
-        )
+
+    # Detailed narrative description, picked by the first keyword found in the description
+    desc_lower = weather['description'].lower()
+    template = next((t for k, t in WEATHER_TEMPLATES.items() if k in desc_lower), DEFAULT_WEATHER_TEMPLATE)
+    description = template.substitute(weather)
 
     # If this is a future date query (e.g., "after 3 days"), format the response as requested
     if days_ahead is not None:
         date_obj = datetime.strptime(weather['date'], '%Y-%m-%d')
         formatted_date = date_obj.strftime('%d %B')
-        return f"the weather after {days_ahead} days in {formatted_date} will be like {{ {weather_details} }}\n\n{description}"
+        # Basic weather details for the concise format, built as one f-string
+        return (
+            f"the weather after {days_ahead} days in {formatted_date} will be like {{ "
+            f"Temperature: {weather['temperature']}°C, Weather: {weather['description']}, "
+            f"Humidity: {weather['humidity']}%, Pressure: {weather['pressure']} hPa, "
+            f"Wind Speed: {weather['wind_speed']} m/s }}\n\n{description}"
+        )
 
     # Default format for current or other date queries
-    return f"{description}"
+    return description
+
+# Explicit YYYY-MM-DD dates in user queries
+DATE_RE = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+_STRPTIME = datetime.strptime
+
 # Function to extract explicit dates in YYYY-MM-DD format
 def extract_date_from_query(query):
     """Extract explicit date in YYYY-MM-DD format from the user's query. Let the agent handle natural language dates."""
-    date_pattern = r"\b(\d{4}-\d{2}-\d{2})\b"
-    match = re.search(date_pattern, query)
+    match = DATE_RE.search(query)
     if match:
         try:
-            return datetime.strptime(match.group(0), "%Y-%m-%d")
+            return _STRPTIME(match.group(0), "%Y-%m-%d")
         except Exception:
             return None
     return None
 
+# Function to resolve the requested date: today maps to None so the lightweight /weather endpoint is used
+def _resolve_date(date):
+    now = datetime.utcnow()
+    if date is None or date.date() == now.date():
+        return None, None
+    # Calculate days ahead if the date is in the future
+    days_ahead = (date.date() - now.date()).days if date > now else None
+    return date, days_ahead
+
 # Function to fetch weather without providing location
 def get_weather_without_location(query, date=None):
-    # If no date is provided by the agent, default to today
-    if date is None:
-        date = datetime.utcnow()
-
     location = get_location_by_ip()
     if location:
-        # Calculate days ahead if the date is in the future
-        days_ahead = (date.date() - datetime.utcnow().date()).days if date > datetime.utcnow() else None
+        date, days_ahead = _resolve_date(date)
         weather = get_weather(location, date)
         return format_weather_response(weather, days_ahead)
     else:
@@ -164,30 +371,16 @@ def get_weather_without_location(query, date=None):
 
 # Function to fetch weather for a specific location
 def get_weather_for_location(location, date=None):
-    # If no date is provided, default to today
-    if date is None:
-        date = datetime.utcnow()
-    
-    # Calculate days ahead if the date is in the future
-    days_ahead = (date.date() - datetime.utcnow().date()).days if date > datetime.utcnow() else None
+    date, days_ahead = _resolve_date(date)
     weather = get_weather(location, date)
     return format_weather_response(weather, days_ahead)
 
-# Define tools for the agent
-get_weather_by_ip = Tool(
-    name="get_weather_by_ip",
-    func=lambda query: get_weather_without_location(query, extract_date_from_query(query)),
-    description="Get weather for a location based on user's IP. The agent should interpret natural language dates (e.g., 'today', 'tomorrow', 'next week', 'in 3 days') relative to May 23, 2025, and pass the date to this tool. If no date is specified, it defaults to the current date."
-)
-
-get_current_weather = Tool(
-    name="get_current_weather",
-    func=lambda location: get_weather_for_location(location, extract_date_from_query(location)),
-    description="Get weather for a specific location. Input should be a city name. The agent should interpret natural language dates (e.g., 'today', 'tomorrow', 'next week', 'in 3 days') relative to May 23, 2025, and pass the date to this tool. If no date is specified, it defaults to the current date."
-)
+# Async wrappers so the agent can run independent tool calls concurrently
+async def aget_weather_without_location(query):
+    return await asyncio.to_thread(get_weather_without_location, query, extract_date_from_query(query))
 
-# Initialize the agent with chat history support
-tools = [get_current_weather, get_weather_by_ip]
+async def aget_weather_for_location(location):
+    return await asyncio.to_thread(get_weather_for_location, location, extract_date_from_query(location))
 
 system_prompt = """
 You are a helpful assistant that provides weather information using the OpenWeatherMap API. You can answer questions about current weather and forecasts. Use the tools to fetch weather data.
@@ -209,36 +402,103 @@ You are a helpful assistant that provides weather information using the OpenWeat
 - Provide clear, concise weather information, including temperature, weather description, humidity, pressure, and wind speed.
 """
 
-agent = initialize_agent(
-    tools=tools,
-    llm=llm,
-    agent_type=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
-    verbose=True,
-    system_message=system_prompt,
-    handle_parsing_errors=True,
-)
+# Function to build the LLM, tools and agent once per process instead of on every Streamlit rerun
+@st.cache_resource
+def build_agent():
+    # Persist LLM completions so identical prompts skip the Groq round trip
+    set_llm_cache(SQLiteCache(database_path=os.path.join(tempfile.gettempdir(), "llm.db")))
+
+    # Initialize LLM model (ChatGroq)
+    llm = ChatGroq(
+        model="llama3-70b-8192",
+        temperature=0.5,
+        request_timeout=15,
+        max_retries=2,
+    )
+
+    # Define tools for the agent
+    get_weather_by_ip = Tool(
+        name="get_weather_by_ip",
+        func=lambda query: get_weather_without_location(query, extract_date_from_query(query)),
+        coroutine=aget_weather_without_location,
+        description="Get weather for a location based on user's IP. The agent should interpret natural language dates (e.g., 'today', 'tomorrow', 'next week', 'in 3 days') relative to May 23, 2025, and pass the date to this tool. If no date is specified, it defaults to the current date.",
+    )
+
+    get_current_weather = Tool(
+        name="get_current_weather",
+        func=lambda location: get_weather_for_location(location, extract_date_from_query(location)),
+        coroutine=aget_weather_for_location,
+        description="Get weather for a specific location. Input should be a city name. The agent should interpret natural language dates (e.g., 'today', 'tomorrow', 'next week', 'in 3 days') relative to May 23, 2025, and pass the date to this tool. If no date is specified, it defaults to the current date.",
+    )
+
+    tools = [get_current_weather, get_weather_by_ip]
+
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        MessagesPlaceholder("chat_history", optional=True),
+        ("human", "{input}"),
+        MessagesPlaceholder("agent_scratchpad"),
+    ])
+
+    # Tool-calling agent: multi-location queries fan out into parallel tool calls
+    return AgentExecutor(
+        agent=create_tool_calling_agent(llm, tools, prompt),
+        tools=tools,
+        verbose=True,
+        handle_parsing_errors=True,
+    )
+
+agent = build_agent()
+
+# Function to run the agent, memoized per query, UTC day, client IP and chat history so Streamlit
+# reruns don't re-hit Groq. History is part of the key so follow-ups like "what about tomorrow?"
+# aren't answered from a different conversation.
+@st.cache_data(ttl=300, show_spinner=False)
+def invoke_agent(query, date_bucket, client_ip, chat_history):
+    _client_ip_var().set(client_ip)
+    response = asyncio.run(agent.ainvoke({"input": query, "chat_history": list(chat_history)}))
+    # Use the tool's output directly if available, falling back to the agent's response
+    return response.get("output", response) if isinstance(response, dict) else response
+
 # Streamlit application for user input and output display
 st.title("Weather Query Agent")
 
 st.write("This is an AI-powered weather assistant. You can ask about the current weather and forecasts.")
 
+# Chat history is bounded so memory and rerun cost stay flat over long sessions
+CHAT_HISTORY_MAXLEN = 50
+# Only the most recent turns are sent to the LLM to bound prompt size
+CHAT_HISTORY_CONTEXT_TURNS = 10
+
 # Initialize chat history for agent's memory
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
+    st.session_state.chat_history = deque(maxlen=CHAT_HISTORY_MAXLEN)
 
 
 # User input for the weather query
 user_query = st.text_input("Ask a weather-related question:", value="")
 
-if user_query:
+history = st.session_state.chat_history
+if user_query and history and history[-1]["user"] == user_query:
+    # A rerun from another widget keeps the same input: reuse the last answer instead of adding a turn
+    tool_output = history[-1]["agent"]
+elif user_query:
     with st.spinner("Getting response..."):
-        # Run the agent with the user query
-        response = agent.invoke(user_query, handle_parsing_errors=True)
-        # Use the tool's output directly if available, falling back to the agent's response
-        tool_output = response.get("output", response) if isinstance(response, dict) else response
+        # Run the agent with the user query and the most recent turns as context
+        recent_turns = list(history)[-CHAT_HISTORY_CONTEXT_TURNS:]
+        chat_history = tuple(
+            message
+            for turn in recent_turns
+            for message in (("human", turn["user"]), ("ai", turn["agent"]))
+        )
+        normalized_query = user_query.strip().lower()
+        tool_output = invoke_agent(
+            normalized_query, datetime.utcnow().date().isoformat(), get_client_ip(), chat_history
+        )
         # Save chat history for agent's memory
-        st.session_state.chat_history.append({"user": user_query, "agent": tool_output})
+        history.append({"user": user_query, "agent": tool_output})
 
+if user_query:
     st.write("**Agent Response:**")
     st.write(tool_output)
 else: